@@ -3,24 +3,100 @@ from __future__ import annotations
 
 import collections
 import datetime
+import functools
 import logging
 import re
 
 import pandas as pd
 from beancount.core import account_types
-from beancount.core import amount
 from beancount.core import convert
 from beancount.core import data
-from beancount.core import inventory
 from beancount.core import prices
 from beancount.core.data import Custom
 from beancount.core.number import Decimal
 from beancount.parser import options
-from beancount.query import query
+from beancount.utils import bisect_key
 from dateutil.relativedelta import relativedelta
 from fava_envelope.modules import budget_tree
+from fava_envelope.modules.budget_tree import from_cents, to_cents
+
+
+@functools.lru_cache(maxsize=4096)
+def _compile(pattern):
+    # The extension is rebuilt on every page load, keep the compiled
+    # settings patterns around between instances
+    return re.compile(pattern)
+
+
+def _join_regexps(regexps, parts):
+    # Joining can renumber the backreferences of patterns with groups, and
+    # an inline global flag either fails to compile once joined (3.11+) or
+    # applies to every alternative, those lists are matched one pattern at
+    # a time instead
+    if any(r.groups or r.flags & ~re.UNICODE for r in regexps):
+        return None
+    try:
+        return _compile("|".join(parts))
+    except re.error:
+        return None
+
+
+def _first_match(regexps, string):
+    # The first pattern that matches wins, returns its index and the match
+    for i, regexp in enumerate(regexps):
+        m = regexp.match(string)
+        if m:
+            return i, m
+    return None, None
+
+
+class _MatchAny:
+    # Stands in for a combined pattern that could not be joined
+    def __init__(self, regexps):
+        self.regexps = regexps
+
+    def match(self, string):
+        return _first_match(self.regexps, string)[1]
+
+
+def _combine_regexps(regexps):
+    # Fold a list of compiled patterns into one alternation so matching an
+    # account costs a single regex call, an empty list never matches
+    if not regexps:
+        return _compile(r"(?!)")
+    combined = _join_regexps(regexps, [f"(?:{r.pattern})" for r in regexps])
+    if combined is None:
+        return _MatchAny(regexps)
+    return combined
+
+
+def _combine_mappings(mappings):
+    # Same as above, but every pattern gets a named group so the matching
+    # mapping can be recovered from lastgroup, first pattern still wins.
+    # Returns a function giving the mapped account, or None
+    if not mappings:
+        def lookup(account):
+            return None
+        return lookup
+
+    regexps = [regexp for regexp, _ in mappings]
+    targets = [target for _, target in mappings]
+    combined = _join_regexps(regexps, [
+        f"(?P<m{i}>{regexp.pattern})" for i, regexp in enumerate(regexps)])
+
+    def lookup(account):
+        if combined is None:
+            i = _first_match(regexps, account)[0]
+        else:
+            m = combined.match(account)
+            i = int(m.lastgroup[1:]) if m else None
+        return None if i is None else targets[i]
+
+    return lookup
 
 
+# envelope_df keeps money as int64 cents so pandas can add and sum whole
+# columns natively, values are turned back into Decimal on the way out
 class BeancountEnvelope:
     def __init__(self, filtered, options_map, currency, date_start, date_end):
 
@@ -38,6 +114,10 @@ class BeancountEnvelope:
             self.etype = "envelope" + self.currency
         else:
             self.etype = "envelope"
+        self.custom_entries_ = [
+            e for e in self.entries
+            if isinstance(e, Custom) and e.type == self.etype
+        ]
 
         (  start_date,
            self.budget_accounts,
@@ -45,6 +125,10 @@ class BeancountEnvelope:
            self.income_accounts,
            self.months_ahead,
         ) = self._find_envelop_settings()
+        self.budget_re = _combine_regexps(self.budget_accounts)
+        self.income_re = _combine_regexps(self.income_accounts)
+        self.map_account = _combine_mappings(self.mappings)
+        self.account_cache_ = {}
 
         if not self.currency:
             self.currency = self._find_currency(options_map)
@@ -56,13 +140,21 @@ class BeancountEnvelope:
         self.date_start = datetime.datetime.strptime(start_date, "%Y-%m").date()
         self.date_end = datetime.date(today.year, today.month, today.day) + relativedelta(months=+self.months_ahead)
 
-        self.price_map = prices.build_price_map(self.entries)
+        self.price_map_ = None
         self.acctypes = options.get_account_types(options_map)
 
         assert self.date_start
         assert self.date_end
 
 
+    @property
+    def price_map(self):
+        # Built on first use and only from the Price directives
+        if self.price_map_ is None:
+            self.price_map_ = prices.build_price_map(
+                [e for e in self.entries if isinstance(e, data.Price)])
+        return self.price_map_
+
     def _find_currency(self, options_map):
         default_currency = "USD"
         opt_currency = options_map.get("operating_currency")
@@ -82,27 +174,48 @@ class BeancountEnvelope:
         income_accounts = []
         months_ahead = 0
 
-        for e in self.entries:
-            if isinstance(e, Custom) and e.type == self.etype:
-                if e.values[0].value == "start date":
-                    start_date = e.values[1].value
-                if e.values[0].value == "budget account":
-                    budget_accounts.append(re.compile(e.values[1].value))
-                if e.values[0].value == "mapping":
-                    map_set = (
-                        re.compile(e.values[1].value),
-                        e.values[2].value,
-                    )
-                    mappings.append(map_set)
-                if e.values[0].value == "income account":
-                    income_accounts.append(re.compile(e.values[1].value))
-                if e.values[0].value == "currency":
-                    self.currency = e.values[1].value
-                if e.values[0].value == "negative rollover":
-                    if e.values[1].value == "allow":
-                        self.negative_rollover = True
-                if e.values[0].value == "self.months_ ahead":
-                    months_ahead = int(e.values[1].value)
+        def set_start_date(e):
+            nonlocal start_date
+            start_date = e.values[1].value
+
+        def add_budget_account(e):
+            budget_accounts.append(_compile(e.values[1].value))
+
+        def add_mapping(e):
+            map_set = (
+                _compile(e.values[1].value),
+                e.values[2].value,
+            )
+            mappings.append(map_set)
+
+        def add_income_account(e):
+            income_accounts.append(_compile(e.values[1].value))
+
+        def set_currency(e):
+            self.currency = e.values[1].value
+
+        def set_negative_rollover(e):
+            if e.values[1].value == "allow":
+                self.negative_rollover = True
+
+        def set_months_ahead(e):
+            nonlocal months_ahead
+            months_ahead = int(e.values[1].value)
+
+        handlers = {
+            "start date": set_start_date,
+            "budget account": add_budget_account,
+            "mapping": add_mapping,
+            "income account": add_income_account,
+            "currency": set_currency,
+            "negative rollover": set_negative_rollover,
+            "self.months_ ahead": set_months_ahead,
+        }
+
+        for e in self.custom_entries_:
+            handler = handlers.get(e.values[0].value)
+            if handler:
+                handler(e)
         return (
             start_date,
             budget_accounts,
@@ -116,10 +229,9 @@ class BeancountEnvelope:
             for month in self.months_:
                 k = (month, "activity")
                 if k not in row: continue
-                actual = row[month, "activity"]
+                actual = from_cents(row[month, "activity"])
                 name = row.name
-                if not actual.is_nan():
-                    self.tree.change_actual("monthly", month, name, actual)
+                self.tree.change_actual("monthly", month, name, actual)
 
         for i, row in self.year_actual.iterrows():
             for year in self.years_:
@@ -142,59 +254,44 @@ class BeancountEnvelope:
         # self.tree.sankey_output()
 
     def _get_months(self):
-        self.months_ = []
-        date_current = self.date_start
-        while date_current < self.date_end:
-            self.months_.append(
-                f"{date_current.year}-{str(date_current.month).zfill(2)}"
-            )
-            month = date_current.month - 1 + 1
-            year = date_current.year + month // 12
-            month = month % 12 + 1
-            date_current = datetime.date(year, month, 1)
+        # Every month whose first day falls before the end date
+        self.months_ = pd.period_range(
+            start=self.date_start,
+            end=self.date_end - datetime.timedelta(days=1),
+            freq="M",
+        ).strftime("%Y-%m").tolist()
         return self.months_
 
     def _set_available(self):
-        for i, row in self.envelope_df.iterrows():
-            for index2, month in enumerate(self.months_):
-                if month not in row: continue
-                row[month, "available"] = Decimal(row[month, "budgeted"]) + Decimal(row[month, "activity"])
+        if self.envelope_df.columns.empty:
+            return
+        budgeted = self.envelope_df.xs("budgeted", level="col", axis=1)
+        activity = self.envelope_df.xs("activity", level="col", axis=1)
+        self.envelope_df.loc[:, (slice(None), "available")] = (
+            budgeted + activity).values
 
     def _set_start_balance(self):
-        # Calculate Starting Balance Income
-        starting_balance = Decimal(0.0)
-        query_str = (
-            f"select account, convert(sum(position),'{self.currency}')"
-            + f" from close on {self.months_[0]}-01 group by 1 order by 1;"
-        )
-        rows = query.run_query(
-            self.entries, self.options_map, query_str, numberify=True)
-
-        for row in rows[1]:
-            if any(regexp.match(row[0]) for regexp in self.budget_accounts):
-                if row[1] is not None:
-                    starting_balance += row[1]
-
-        self.income_df[self.months_[0]]["Avail Income"] += starting_balance
+        # Starting Balance Income, summed by _collect_budget_txns. Converted
+        # postings carry the price's precision, round like the other cells
+        self.income_df.loc["Avail Income", self.months_[0]] += (
+            self.starting_balance_.quantize(self.Q))
 
     def _set_overspent(self):
-        overspent = Decimal(0)
-        for index, month in enumerate(self.months_):
-            if index == 0:
-                self.income_df.loc["Overspent", month] = Decimal(0.00)
-            else:
-                overspent = Decimal(0.00)
-                for index2, row in self.envelope_df.iterrows():
-                    cur = (self.months_[index - 1], "available")
-                    if cur in row and row[cur] < Decimal(0.00):
-                        overspent += Decimal(row[cur])
-                self.income_df.loc["Overspent", month] = overspent
+        if self.envelope_df.columns.empty:
+            overspent = pd.Series(0, index=self.months_)
+        else:
+            available = self.envelope_df.xs("available", level="col", axis=1)
+            overspent = available.clip(upper=0).sum(axis=0).reindex(
+                self.months_, fill_value=0)
+        # What was overspent in a month is carried into the next one
+        overspent = overspent.shift(1, fill_value=0)
+        self.income_df.loc["Overspent"] = overspent.map(from_cents)
 
     def _set_extra(self):
         # Set Budgeted for month
         for month in self.months_:
             if (month, "budgeted") in self.envelope_df:
-                self.income_df.loc["Budgeted", month] = Decimal(
+                self.income_df.loc["Budgeted", month] = from_cents(
                     -1 * self.envelope_df[month, "budgeted"].sum())
 
     def _get_years(self):
@@ -217,11 +314,11 @@ class BeancountEnvelope:
             names=["Month", "col"],)
         self.envelope_df = pd.DataFrame(columns=column_index)
         self.envelope_df.index.name = "Envelopes"
-        self.envelope_df.fillna(Decimal(0.00), inplace=True)
 
         self.task_df = pd.DataFrame(columns=["activity"])
         self.task_df.index.name = "Tasks"
 
+        self._collect_budget_txns()
         self._calc_budget_activity()
         self._calc_budget_budgeted()
         self._calc_budget_tasks()
@@ -232,207 +329,226 @@ class BeancountEnvelope:
         self._set_extra()
         self._fill_budget_tree()
 
+        self.envelope_df = self.envelope_df.apply(
+            lambda col: col.map(from_cents))
+
         # print(self.income_df)
         # print(self.envelope_df)
         return self.income_df, self.envelope_df, self.currency
 
-    def _calc_budget_tasks(self):
-        balances = collections.defaultdict(
-            lambda: collections.defaultdict(inventory.Inventory))
-
+    def _classify_account(self, account):
+        # Resolve the mapping, the account type and the income / budget
+        # regexes once per account string, postings repeat the same few
+        # accounts many times
+        if account in self.account_cache_:
+            return self.account_cache_[account]
+
+        mapped = self.map_account(account)
+        if mapped is None:
+            mapped = account
+
+        account_type = account_types.get_account_type(mapped)
+        ans = (
+            mapped,
+            account_type == self.acctypes.income
+            or bool(self.income_re.match(mapped)),
+            bool(self.budget_re.match(account)),
+        )
+        self.account_cache_[account] = ans
+        return ans
+
+    def _in_date_range(self, entries):
+        # Entries are sorted by date, so the budget window is a contiguous
+        # slice that can be found by bisection
+        lo = bisect_key.bisect_left_with_key(
+            entries, self.date_start, key=lambda e: e.date)
+        hi = bisect_key.bisect_right_with_key(
+            entries, self.date_end, key=lambda e: e.date)
+        return entries[lo:hi]
+
+    def _collect_budget_txns(self):
+        # Filter the transactions once for both the activity and task passes:
+        # in the budget date range and touching at least one budget account.
+        # Everything before the range only adds to the starting balance
+        self.budget_txns_ = []
+        self.txn_months_ = set()
+        self.starting_balance_ = Decimal(0)
         for entry in data.filter_txns(self.entries):
-            # Check entry in date range
-            if entry.date < self.date_start or entry.date > self.date_end:
+            if entry.date > self.date_end:
+                break
+            if entry.date < self.date_start:
+                for posting in entry.postings:
+                    if self._classify_account(posting.account)[2]:
+                        self.starting_balance_ += self._start_value(posting)
                 continue
 
-            tasks = (entry.tags | entry.links) & self.tasks_
-            if len(tasks) == 0:
-                continue
-
-            contains_budget_accounts = False
+            # TODO domwe handle no transaction in a month?
+            self.txn_months_.add((entry.date.year, entry.date.month))
             for posting in entry.postings:
-                if any(regexp.match(posting.account) for regexp in self.budget_accounts):
-                    contains_budget_accounts = True
+                if self._classify_account(posting.account)[2]:
+                    self.budget_txns_.append(entry)
                     break
-            if not contains_budget_accounts:
+
+    def _start_value(self, posting):
+        if posting.units.currency == self.currency:
+            return posting.units.number
+        value = convert.convert_position(
+            posting, self.currency, self.price_map)
+        return value.number if value.currency == self.currency else 0
+
+    def _calc_budget_tasks(self):
+        rows = []
+
+        for entry in self.budget_txns_:
+            tasks = (entry.tags | entry.links) & self.tasks_
+            if len(tasks) == 0:
                 continue
 
             for posting in entry.postings:
-                account = posting.account
-                for regexp, target_account in self.mappings:
-                    if regexp.match(account):
-                        account = target_account
-                        break
+                account, is_income, is_budget = self._classify_account(
+                    posting.account)
 
-                account_type = account_types.get_account_type(account)
+                number = posting.units.number
                 if posting.units.currency != self.currency:
-                    orig = posting.units.number
-                    if posting.price is not None:
-                        converted = posting.price.number * orig
-                        posting = data.Posting(
-                            posting.account,
-                            amount.Amount(converted, self.currency),
-                            posting.cost,
-                            None,
-                            posting.flag,
-                            posting.meta)
-                    else:
+                    if posting.price is None:
                         continue
+                    number = posting.price.number * number
 
-                if account_type == self.acctypes.income or (any(regexp.match(account) for regexp in self.income_accounts)):
+                if is_income:
                     account = "Income"
-                elif any(regexp.match(posting.account) for regexp in self.budget_accounts):
+                elif is_budget:
                     continue
 
                 for task in tasks:
-                    balances[account][task].add_position(posting)
-
-        # Reduce the final balances to numbers
-        for account, tasks in sorted(balances.items()):
-            for task, balance in sorted(tasks.items()):
-                balance = balance.reduce(convert.get_value, self.price_map)
-                balance = balance.reduce(convert.convert_position, self.currency, self.price_map)
-                pos = balance.get_only_position()
-                total = pos.units.number if pos and pos.units else None
-
-                if account in self.task_df.index:
-                    if pd.isna(self.task_df.loc[account, task]):
-                        self.task_df.loc[account, task] = total
-                    else:
-                        self.task_df.loc[account, task] += total
-                else:
-                    self.task_df.loc[account, task] = total
+                    rows.append((account, task, number))
 
+        # Sum the postings per account and task
+        totals = pd.DataFrame(
+            rows, columns=["account", "task", "number"]).groupby(
+                ["account", "task"])["number"].sum()
 
-    def _calc_budget_activity(self):
-        # Accumulate expenses for the period
-        balances = collections.defaultdict(
-            lambda: collections.defaultdict(inventory.Inventory)
-        )
-        all_months = set()
-        for entry in data.filter_txns(self.entries):
-
-            # Check entry in date range
-            if entry.date < self.date_start or entry.date > self.date_end:
-                continue
+        task_rows = {}
+        columns = dict.fromkeys(self.task_df.columns)
+        for (account, task), total in totals.items():
+            task_rows.setdefault(account, {})[task] = total
+            columns.setdefault(task, None)
 
-            month = (entry.date.year, entry.date.month)
-            # TODO domwe handle no transaction in a month?
-            all_months.add(month)
-            contains_budget_accounts = False
-            for posting in entry.postings:
-                if any(regexp.match(posting.account) for regexp in self.budget_accounts):
-                    contains_budget_accounts = True
-                    break
-
-            if not contains_budget_accounts:
-                continue
+        self.task_df = pd.DataFrame.from_dict(
+            task_rows, orient="index").reindex(columns=list(columns))
+        self.task_df.index.name = "Tasks"
 
+    def _calc_budget_activity(self):
+        # Accumulate expenses for the period
+        rows = []
+        for entry in self.budget_txns_:
             for posting in entry.postings:
+                account, is_income, is_budget = self._classify_account(
+                    posting.account)
 
-                account = posting.account
-                for regexp, target_account in self.mappings:
-                    if regexp.match(account):
-                        account = target_account
-                        break
-
-                account_type = account_types.get_account_type(account)
+                number = posting.units.number
                 if posting.units.currency != self.currency:
-                    orig = posting.units.number
-                    if posting.price is not None:
-                        converted = posting.price.number * orig
-                        posting = data.Posting(
-                            posting.account,
-                            amount.Amount(converted, self.currency),
-                            posting.cost,
-                            None,
-                            posting.flag,
-                            posting.meta,
-                        )
-                    else:
+                    if posting.price is None:
                         continue
+                    number = posting.price.number * number
 
-                if account_type == self.acctypes.income or (
-                    any(regexp.match(account) for regexp in self.income_accounts)
-                ):
+                if is_income:
                     account = "Income"
-                elif any(regexp.match(posting.account) for regexp in self.budget_accounts):
+                elif is_budget:
                     # print("AAAAAAAAAAA", posting.account)
                     continue
                 # TODO WARn of any assets / liabilities left
 
-                balances[account][month].add_position(posting)
+                rows.append((
+                    account,
+                    entry.date.year,
+                    entry.date.month,
+                    number,
+                ))
 
-        # print(balances)
+        # Sum the postings per account and month, every posting left is
+        # already in the budget currency
+        totals = pd.DataFrame(
+            rows, columns=["account", "year", "month", "number"]).groupby(
+                ["account", "year", "month"])["number"].sum()
 
-        # Reduce the final balances to numbers
         sbalances = collections.defaultdict(dict)
-        for account, months in sorted(balances.items()):
-            for month, balance in sorted(months.items()):
-                year, mth = month
-                date = datetime.date(year, mth, 1)
-                balance = balance.reduce(convert.get_value, self.price_map, date)
-                balance = balance.reduce(
-                    convert.convert_position,
-                    self.currency,
-                    self.price_map,
-                    date,
-                )
-                try:
-                    pos = balance.get_only_position()
-                except AssertionError:
-                    print(balance)
-                    raise
-                total = pos.units.number if pos and pos.units else None
-                sbalances[account][month] = total
-
-        # Pivot the table
-        self.income_df.loc["Avail Income", :] = Decimal(0.00)
-
-        for account in sorted(sbalances.keys()):
-            for month in sorted(all_months):
-                total = sbalances[account].get(month, None)
+        for (account, year, mth), total in totals.items():
+            sbalances[account][year, mth] = total
+
+        # Pivot the table, collecting plain dicts first and building each
+        # DataFrame in one go rather than assigning cell by cell
+        avail_income = {}
+        activity = {}
+        year_actual = {}
+        # groupby already yields the accounts in sorted order, which is the
+        # row order of the envelope table
+        for account, months in sbalances.items():
+            for month in self.txn_months_:
+                total = months.get(month, None)
                 temp = total.quantize(self.Q) if total else 0.00
                 # swap sign to be more human readable
                 temp *= -1
 
                 m = f"{str(month[0])}-{str(month[1]).zfill(2)}"
                 if account == "Income":
-                    self.income_df.loc["Avail Income", m] = Decimal(temp)
+                    avail_income[m] = Decimal(temp)
                 else:
-                    self.envelope_df.loc[account, (m, "budgeted")] = Decimal(0.00)
-                    self.envelope_df.loc[account, (m, "activity")] = Decimal(temp)
-                    self.envelope_df.loc[account, (m, "available")] = Decimal(0.00)
+                    row = activity.setdefault(account, {})
+                    row[m, "budgeted"] = 0
+                    row[m, "activity"] = to_cents(temp)
+                    row[m, "available"] = 0
+                    years = year_actual.setdefault(account, {})
                     year_ss = "budget-" + str(month[0])
-                    if account in self.year_actual.index:
-                        if pd.isna(self.year_actual.loc[account, year_ss]):
-                            self.year_actual.loc[account, year_ss] = Decimal(temp)
-                        else:
-                            self.year_actual.loc[account, year_ss] += Decimal(temp)
+                    if year_ss in years:
+                        years[year_ss] += Decimal(temp)
                     else:
-                        self.year_actual.loc[account, year_ss] = Decimal(temp)
+                        years[year_ss] = Decimal(temp)
+
+        self.income_df.loc["Avail Income", :] = Decimal(0.00)
+        if avail_income:
+            self.income_df.loc["Avail Income", list(avail_income)] = list(
+                avail_income.values())
+
+        self.envelope_df = pd.DataFrame.from_dict(
+            activity, orient="index", dtype="int64").reindex(
+                columns=self.envelope_df.columns, fill_value=0)
+        self.envelope_df.index.name = "Envelopes"
+
+        self.year_actual = pd.DataFrame.from_dict(
+            year_actual, orient="index").reindex(columns=self.years_)
+        self.year_actual.index.name = "Account"
 
         # print(self.envelope_df)
         # print(self.year_actual)
 
     def _calc_budget_budgeted(self):
-        for e in self.entries:
-            if isinstance(e, Custom) and e.type == self.etype:
-                # Check entry in date range
-                if e.date < self.date_start or e.date > self.date_end:
-                    continue
-
-                if e.values[0].value == "allocate":
-                    month = f"{e.date.year}-{e.date.month:02}"
-                    vals = [x.value for x in e.values]
-                    self.envelope_df.loc[vals[-2], (month, "budgeted")] = Decimal(vals[-1])
+        budgeted = {}
+        for e in self._in_date_range(self.custom_entries_):
+            if e.values[0].value == "allocate":
+                month = f"{e.date.year}-{e.date.month:02}"
+                vals = [x.value for x in e.values]
+                budgeted[vals[-2], month] = to_cents(vals[-1])
+
+        # Envelopes that only have allocations get a row of zeros, then all
+        # budgeted columns are written at once, so no cell is ever NaN
+        if budgeted:
+            allocated = pd.Series(budgeted).unstack(fill_value=0)
+            new_envelopes = [
+                account for account in dict.fromkeys(a for a, _ in budgeted)
+                if account not in self.envelope_df.index
+            ]
+            index = self.envelope_df.index.append(
+                pd.Index(new_envelopes)).rename("Envelopes")
+            self.envelope_df = self.envelope_df.reindex(
+                index=index, fill_value=0)
+            self.envelope_df.loc[:, (slice(None), "budgeted")] = (
+                allocated.reindex(
+                    index=index, columns=self.months_, fill_value=0).values)
 
         # First drop all months that have no budget
-        months_to_drop = []
-        for month in self.months_:
-            if self.envelope_df[month, "budgeted"].sum() == 0:
-                months_to_drop.append(month)
-        self.envelope_df = self.envelope_df.drop(months_to_drop, axis=1)
-        self.envelope_df.fillna(Decimal(0.00), inplace=True)
+        budgeted = self.envelope_df.xs("budgeted", level="col", axis=1)
+        keep = budgeted.sum(axis=0) != 0
+        self.envelope_df = self.envelope_df.loc[
+            :, keep.reindex(self.envelope_df.columns, level="Month").values]
 
         # print(self.envelope_df)
\ No newline at end of file
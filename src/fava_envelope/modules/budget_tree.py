@@ -1,88 +1,148 @@
+import collections
 import datetime
+import operator
 import re
+import sys
 
-from typing import NamedTuple, Any, List, Set
+from typing import Any, List, Set
+from beancount.core import amount
 from beancount.core import data
 from beancount.core.number import Decimal
 from beancount.core import inventory
 from dateutil.relativedelta import relativedelta
-from fava_envelope.modules import ordered_set
 
-BudgetTreeNode = NamedTuple(
-    'BudgetTreeNode', [
-        ('name', str),
-        ('budget', Any),
-        ('actual', Any)])
+# Money is summed as int cents, here and in the envelope tables, every
+# value is rounded to the cent anyway so Decimal is only needed at the ends
+CENT = Decimal("0.01")
+
+
+def to_cents(number):
+    return int(Decimal(number).quantize(CENT) * 100)
+
+
+def from_cents(cents):
+    # int() also takes the numpy integers coming out of pandas
+    return Decimal(int(cents)).scaleb(-2)
+
+
+# Custom directives that add a path to the tree
+BUDGET_DIRECTIVES = frozenset(("allocate", "task"))
+
+# Names of the month and year budget nodes
+MONTH_RE = re.compile(r"\d\d\d\d-\d\d")
+YEAR_BUDGET_RE = re.compile(r"budget-\d\d\d\d")
+
+
+class BudgetTreeNode:
+    # Mutable so summarize and change_actual can update a node in place
+    __slots__ = ('name', 'budget', 'actual')
+
+    def __init__(self, name: str, budget: Any = None, actual: Any = None) -> None:
+        self.name = name
+        self.budget = budget
+        self.actual = actual
 
 class BudgetTree:
+    # No per-node __dict__, a tree has one object per budget node
+    __slots__ = (
+        'node_', 'budget_cents_', 'actual_cents_', 'children_', 'child_set_',
+        'parents_', 'node_map_', 'name_index_', 'preorder_', 'summarized_', 'tasks_',
+        'max_date_')
+
     def __init__(self, n="Budget Tree", b=None, a=None) -> None:
         self.node_ = BudgetTreeNode(name=n, budget=b, actual=a)
-        self.children_ = ordered_set.OrderedSet()
-        self.visit_ = set()
+        # Totals of the node in cents, filled in by summarize
+        self.budget_cents_ = None
+        self.actual_cents_ = None
+        self.children_ = []
+        self.child_set_ = set()
+        self.parents_ = []
         self.node_map_ = {}
+        self.name_index_ = None
+        self.preorder_ = None
+        self.summarized_ = False
         self.tasks_ = set()
         self.max_date_ = datetime.date.today()
 
     def add_children(self, child):
-        self.children_.add(child)
+        # Nodes are shared through node_map_, so the same child can be added
+        # again by a later entry
+        if child not in self.child_set_:
+            self.child_set_.add(child)
+            self.children_.append(child)
+            child.parents_.append(self)
+            self._reset_caches()
+
+    def _reset_caches(self):
+        # What a node caches covers its whole subtree, so a change below a
+        # node drops the caches of all of its ancestors too. A node can have
+        # more than one parent, see _create_or_get
+        stack = [self]
+        seen = set()
+        while stack:
+            n = stack.pop()
+            if n in seen:
+                continue
+            seen.add(n)
+            n.name_index_ = None
+            n.preorder_ = None
+            n.summarized_ = False
+            stack.extend(n.parents_)
 
     def __getitem__(self, i):
         # For test purpose
-        return list(self.children_)[i]
-
-    def _dfs(self, post=None, pre=None):
-        k = id(self)
-        assert k not in self.visit_
-        self.visit_.add(k)
-
-        if pre:
-            pre(self)
-
-        for c in self.children_:
-            c.dfs(post=post, pre=pre)
-
-        if post:
-            post(self)
+        return self.children_[i]
+
+    def _preorder(self):
+        # Walk the tree once and keep the nodes in pre-order as (node, depth)
+        # pairs, until _reset_caches drops the list
+        if self.preorder_ is None:
+            self.preorder_ = []
+            stack = [(self, 0)]
+            while stack:
+                n, level = stack.pop()
+                self.preorder_.append((n, level))
+                # Reversed so the children are popped in their own order
+                stack.extend((c, level + 1) for c in reversed(n.children_))
+        return self.preorder_
+
+    def _summarize_node(self):
+        node = self.node_
+        if node.name in ("Budget Tree", "tasks", "monthly"):
+            return
+
+        if not self.children_:
+            tot_budget = abs(to_cents(node.budget or 0))
+            tot_actual = abs(to_cents(node.actual or 0))
+        else:
+            tot_budget = sum(c.budget_cents_ for c in self.children_)
+            tot_actual = sum(c.actual_cents_ for c in self.children_)
 
-    def dfs(self, post=None, pre=None):
-        self.visit_.clear()
-        self._dfs(post=post, pre=pre)
+        self.budget_cents_ = tot_budget
+        self.actual_cents_ = tot_actual
+        node.budget = str(from_cents(tot_budget))
+        node.actual = str(from_cents(tot_actual))
 
     def summarize(self):
-        node_sum = {}
-        def post(n : BudgetTree):
-            if n.node_.name in ("Budget Tree", "tasks", "monthly"):
-                return
-
-            tot_budget = Decimal(0)
-            tot_actual = Decimal(0)
-            if len(n.children_) == 0:
-                if n.node_.budget: tot_budget += Decimal(n.node_.budget)
-                if n.node_.actual: tot_actual += Decimal(n.node_.actual)
-            else:
-                for c in n.children_:
-                    tot_budget += node_sum[c][0]
-                    tot_actual += node_sum[c][1]
+        if self.summarized_:
+            return
 
-            tot_budget = abs(Decimal(tot_budget).quantize(Decimal("0.00")))
-            tot_actual = abs(Decimal(tot_actual).quantize(Decimal("0.00")))
-
-            node_sum[n] = (tot_budget, tot_actual)
-            n.node_ = n.node_._replace(budget=str(tot_budget))
-            n.node_ = n.node_._replace(actual=str(tot_actual))
-
-        self.dfs(post=post)
+        # Reversed pre-order has every child ahead of its parent, so the
+        # totals can be summed up in one flat loop
+        for n, _ in reversed(self._preorder()):
+            n._summarize_node()
+        self.summarized_ = True
 
     def parse_entries(self, entries):
         for e in entries:
-            if isinstance(e, data.Custom) and e.values and e.values[0].value in ("allocate", "task"):
+            if type(e) is data.Custom and e.values and e.values[0].value in BUDGET_DIRECTIVES:
                 self.add_children(self._parse_entry(e))
 
     def change_actual(self, task, month, n, v):
-        f = task + month + n
-        if f in self.node_map_:
-            changed = self.node_map_[f].node_._replace(actual=str(v))
-            self.node_map_[f].node_ = changed
+        node = self.node_map_.get((task, month, n))
+        if node is not None:
+            node.node_.actual = str(v)
+            node._reset_caches()
             return True
 
         return False
@@ -90,136 +150,139 @@ class BudgetTree:
     def _create_or_get(self, task, month, n):
         # NOTE: for the same expenses, if task if different, we allocate
         # different nodes
-        f = task + month + n
+        f = (task, month, n)
         if f not in self.node_map_:
             self.node_map_[f] = BudgetTree(n=n)
         return self.node_map_[f]
 
     def _parse_entry(self, e):
-        vals = [x.value for x in e.values[1:]]
-        assert len(vals) >= 2, "allocate A 100"
+        assert len(e.values) >= 3, "allocate A 100"
+        path = tuple(x.value for x in e.values[1:-1])
 
-        # Use month to create the first node
-        month = str(e.date)[0:-3]
+        # Use month to create the first node, every node of the month shares
+        # it in its node_map_ key
+        month = sys.intern(f"{e.date.year:04d}-{e.date.month:02d}")
         self.max_date_ = max(self.max_date_, e.date)
         first = "monthly"
         if e.values[0].value == "task":
             # TODO: This is a Task budget, counted in both month budget and task
             # budget, find txns with same link or tag to count the actual
             first = "tasks"
-            if not vals[0].startswith("budget-"):
-                self.tasks_.add(vals[0])
+            if not path[0].startswith("budget-"):
+                self.tasks_.add(path[0])
                 month = ""
         else:
             # Add month to be first node
-            vals.insert(0, month)
+            path = (month,) + path
 
-        budget = float(vals[-1])
+        budget = float(e.values[-1].value)
 
-        ans = [ self._create_or_get(first, first, first) ]
-        for i, k in enumerate(vals):
-            if i == len(vals) - 1:
-                ans[-1].node_ = ans[-1].node_._replace(budget=str(budget))
-                break
-            cur = self._create_or_get(first, month, k)
-            ans[-1].add_children(cur)
-            ans.append(cur)
+        root = self._create_or_get(first, first, first)
+        cur = root
+        for k in path:
+            child = self._create_or_get(first, month, k)
+            cur.add_children(child)
+            cur = child
+        cur.node_.budget = str(budget)
 
-        # for x in ans:
-        #     print(x.node_, x, x.children_)
-
-        return ans[0]
+        return root
 
     def pretty_output(self):
-        level = {}
-        level[self] = 0
-        def pre(n : BudgetTree):
-            for c in n.children_:
-                level[c] = level[n] + 1
-        self.dfs(pre=pre)
-
-        def pretty(n : BudgetTree):
-            f = "  " * level[n]
-            print(f"{f} {n.node_.name} {n.node_.budget} | {n.node_.actual}")
-        self.dfs(pre=pretty)
+        # Lines are collected and printed at once
+        lines = []
+        for n, level in self._preorder():
+            f = "  " * level
+            node = n.node_
+            lines.append(f"{f} {node.name} {node.budget} | {node.actual}")
+        print("\n".join(lines))
 
     def sankey_output(self):
+        lines = []
         def pre(n: BudgetTree):
-            if len(n.children_) == 0:
-                print(f"{n.node_.name} [{n.node_.budget}] Budget")
-                print(f"{n.node_.name} [{n.node_.actual}] Actual")
+            node = n.node_
+            if not n.children_:
+                lines.append(f"{node.name} [{node.budget}] Budget")
+                lines.append(f"{node.name} [{node.actual}] Actual")
             else:
                 for c in n.children_:
-                    t = float(c.node_.budget) + float(c.node_.actual)
-                    print(f"{n.node_.name} [{t}] {c.node_.name}")
+                    t = float(c.budget_cents_) / 100 + float(c.actual_cents_) / 100
+                    lines.append(f"{node.name} [{t}] {c.node_.name}")
 
-        self.dfs(pre=pre)
+        for n, _ in self._preorder():
+            pre(n)
+        print("\n".join(lines))
 
     def find_node(self, node_name):
-        ans = None
-        def pre(n : BudgetTree):
-            nonlocal ans
-            if ans: return
-            if n.node_.name == node_name:
-                ans = n
-        self.dfs(pre=pre)
-        return ans
+        # Index the names on the first lookup, keeping the first node in
+        # pre-order for each name
+        if self.name_index_ is None:
+            self.name_index_ = {}
+            for n, _ in self._preorder():
+                self.name_index_.setdefault(n.node_.name, n)
+        return self.name_index_.get(node_name)
 
     def sankey_budget(self, filtered, node=None):
         if node is None:
             # NOTE: if node is provided by click a link, use node to render
             date_last = min(filtered._date_last, self.max_date_) + datetime.timedelta(-1)
-            node = str(date_last)[0:-3]
+            node = f"{date_last.year:04d}-{date_last.month:02d}"
 
         root = self.find_node(node)
         if root is None:
-            year = "budget-" + str(datetime.datetime.today())[0:4]
+            year = f"budget-{datetime.date.today().year:04d}"
             root = self.find_node(year)
             assert root, year
 
+        # The wrapper only lives for this call, so it is not registered as
+        # one of root's parents
         new_root = BudgetTree("root")
-        new_root.children_ = set([root])
+        new_root.children_.append(root)
+        new_root.child_set_.add(root)
         root = new_root
 
-        new_root.summarize()
+        if self.summarized_:
+            # The subtree was already summed up with the whole tree, only
+            # the new root needs its totals
+            new_root._summarize_node()
+        else:
+            new_root.summarize()
         new_root.pretty_output()
 
-        nodes = ordered_set.OrderedSet()
+        # dict keeps the node names unique in insertion order
+        nodes = {}
         links = []
         id_map = { root: 100 }
         def pre(n: BudgetTree):
             # NOTE: maintain a order to make sankey graph looks nice
-            children = list(n.children_)
-            children.sort(key=lambda n : float(n.node_.budget), reverse=True)
+            children = sorted(
+                n.children_, key=operator.attrgetter("budget_cents_"),
+                reverse=True)
+
+            if not children:
+                return
 
+            id = id_map[n]
+            nn = str(id) + "_" + n.node_.name
             for i, c in enumerate(children):
-                assert n in id_map
-                id = id_map[n]
-                nn = str(id) + "_" + n.node_.name
                 nc = str(id * 100 + i) + "_" + c.node_.name
                 id_map[c] = id * 100 + i
-                nodes.add(nn)
-                nodes.add(nc)
+                nodes[nn] = None
+                nodes[nc] = None
                 val = str(c.node_.budget).strip()
                 val += ' '
                 val += str(c.node_.actual).strip()
                 links.append([nn, nc, val])
 
-        root.dfs(pre=pre)
+        for n, _ in root._preorder():
+            pre(n)
         return (list(nodes), links)
 
     def bfs(self, func=None):
-        qu = []
-        qu.append(self)
-        i = 0
-        while i < len(qu):
-            u = qu[i]
+        qu = collections.deque([self])
+        while qu:
+            u = qu.popleft()
             if func: func(u)
-
-            for v in u.children_:
-                qu.append(v)
-
-            i += 1
+            qu.extend(u.children_)
 
     def interval_budget(self, filtered):
         # Show month data for a whole year, first find the year budget
@@ -227,25 +290,32 @@ class BudgetTree:
         date_last = min(self.max_date_, filtered._date_last) + datetime.timedelta(-1)
         year = str(date_last.year)
         ans = []
-        begin = datetime.datetime.strptime("1970-01", "%Y-%m").date()
+        begin = datetime.date(1970, 1, 1)
+        one_month = relativedelta(months=+1)
+
+        def to_inventory(number):
+            inv = inventory.Inventory()
+            inv.add_amount(amount.Amount(number, 'CNY'))
+            return inv
+
         def collect(n : BudgetTree):
-            assert n
             nonlocal begin
+            name = n.node_.name
             ok = False
-            if re.match(r"\d\d\d\d-\d\d", n.node_.name) and n.node_.name.startswith(year):
-                begin += relativedelta(months=+1)
+            if MONTH_RE.match(name) and name.startswith(year):
+                begin += one_month
                 ok = True
 
-            elif re.match(r"budget-\d\d\d\d", n.node_.name) and n.node_.name.endswith(year):
-                begin += relativedelta(months=+1)
+            elif YEAR_BUDGET_RE.match(name) and name.endswith(year):
+                begin += one_month
                 ok = True
 
             if not ok: return
 
-            balance = inventory.from_string(str(Decimal(n.node_.budget) - Decimal(n.node_.actual)) + ' CNY')
+            balance = to_inventory(from_cents(n.budget_cents_ - n.actual_cents_))
             account_balances = {
-                n.node_.name + "-budget" : balance,
-                n.node_.name + "-actual" : inventory.from_string(n.node_.actual + ' CNY'),
+                name + "-budget" : balance,
+                name + "-actual" : to_inventory(from_cents(n.actual_cents_)),
             }
             ans.append((begin, balance, account_balances, {}))
 